@@ -1,9 +1,14 @@
+import io
 import os 
 import re 
+import mmap
+import hashlib
+import zipfile
 import json
 import argparse
 import numpy as np
-from glob import glob
+from glob import glob, escape as glob_escape
+from itertools import pairwise
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator, MultipleLocator
 from matplotlib.lines import Line2D
@@ -17,6 +22,9 @@ from matplotlib import colormaps as cm
 # add color selection options
 # create default dict like in other scripts.
 
+_SECTION_RE = re.compile(rb'\n\[([^\]\r\n]+)\]\r?\n') # matches section titles like [step] on their own line
+_CACHE_KEY_RE = re.compile(r'\.[0-9a-f]{16}\.npz') # fully matches the key suffix of the cache files written by get_cached_data
+
 
 # Helper functions for argparse defaults
 def get_default_input(directory=''):
@@ -27,15 +35,22 @@ def get_default_input(directory=''):
 
 	files = glob('%s*.txt'%directory)
 
+	marker = '\n[step]\n'
+
 	for file in files:
 		with open(file) as inf:
-			if '\n[step]\n' in inf.read():
-				return file
+			tail = '' # end of the previous chunk, in case the marker is split between two chunks
+			while chunk := inf.read(64*1024): # scan in chunks instead of reading the entire file
+				if marker in tail + chunk:
+					return file
+				tail = chunk[-len(marker)+1:]
 
 
 defaults = {'input_file':get_default_input(),
 			'extension':'png',
 			'silent':False,
+			'dpi':150,
+			'no_cache':False,
 			'colors':None} # add options
 
 defaults['output_file'] = os.path.splitext(defaults['input_file'])[0] + '.' + defaults['extension']
@@ -46,8 +61,13 @@ parser.add_argument('-o', '--output_file', default=defaults['output_file'], help
 parser.add_argument('-x', '--extension', default=defaults['extension'], help='Specify the output file\'s extension.')
 parser.add_argument('-s', '--silent', default=defaults['silent'], action='store_true', help='Run in silent mode. Do not open interactive')
 parser.add_argument('-c', '--colors', default=defaults['extension'], help='Specify the output file\'s extension.')
+parser.add_argument('-d', '--dpi', default=defaults['dpi'], type=int, help='Specify the resolution of the output file in dots per inch.')
+parser.add_argument('-n', '--no_cache', default=defaults['no_cache'], action='store_true', help='Always parse the input file, do not read or write the .npz cache next to it.')
 args = parser.parse_args()
 
+if args.silent:
+	plt.switch_backend('Agg') # no window is opened, so skip initialising an interactive backend
+
 
 
 def get_data(path:str):
@@ -56,77 +76,58 @@ def get_data(path:str):
 	Input: Path (str)
 	Output: Data (dict).'''
 
-	def find_section_indices(string:str):
+	def find_sections(buf:bytes):
 
-		'''Searches the entire file string for the the section titles and returns their indices as
-		a list of tuples.'''
+		'''Searches the entire file buffer for the the section titles and returns a list of (start, end, title) tuples.
+		The untitled header of the file is returned as the 'general' section, the list is terminated by an untitled
+		entry at the end of the buffer so that every section has a following one.'''
 
-		section_rex = r'\n\[[\w\s]+\]\n'
-		start_indices = []
-		end_indices = []
-		section_titles = []
-		num_steps = 0
+		matches = _SECTION_RE.finditer(buf)
+		return [(0,0,'general')] + [(match.start(),match.end(),match.group(1).decode('utf8')) for match in matches] + [(len(buf),len(buf),'')]
 
-		for match in re.finditer(section_rex,string):
-			start_indices.append(match.start())
-			end_indices.append(match.end())
-			section_titles.append(match.group()[2:-2])
 
-			if match.group() == '\n[step]\n': num_steps += 1 # find out how many steps are in the file 
+	def read_section(buf:bytes,start:int,end:int):
 
-		len_mismatch_msg = '''The amount of opening and closing angular brackets is not identical.
-		This means that the regex is not finding all the sections of the trios file.
-		Contact someone to fix this, or find out why section_rex is not capturing correctly.'''
+		'''Decodes a single section of the file buffer, normalising windows line endings. With those, the section
+		ends on the \r in front of the next title's \n.'''
 
-		assert len(start_indices) == len(end_indices) == len(section_titles), len_mismatch_msg
+		return buf[start:end].decode('utf8').removesuffix('\r').replace('\r\n','\n')
 
-		return start_indices,end_indices,section_titles,num_steps
 
 
+	# map the file instead of reading it, only the sections are decoded into strings.
+	with open(path,'rb') as inf, mmap.mmap(inf.fileno(),0,access=mmap.ACCESS_READ) as raw:
 
-	with open(path,'r',encoding='utf8') as inf:
-		raw = inf.read() # read in entire file as one string.
-
-	raw = '\n[general]\n' + raw
-
-	start_indices, end_indices, section_titles, num_steps = find_section_indices(raw) # find the indices of the different sections inside the file.
-	data = {} # this is where the data will end up.
-	data['meta'] = {}
-	data['steps'] = []
-	
-	# meta_string = raw[:start_indices[-num_steps]] # put meta data part of the string in a separate variable
-	# num_string = raw[start_indices[-num_steps]:]
-	# print(num_string)
-	
-	# obtain the different meta data sections as dict.
-	for i in range(len(start_indices)-num_steps):
-		section_title = section_titles[i]
-		sec_start = start_indices[i] + len(section_title)
-		sec_end = start_indices[i+1]
-		section = raw[sec_start+4:sec_end]
+		sections = find_sections(raw) # find the boundaries of the different sections inside the file.
+		data = {} # this is where the data will end up.
+		data['meta'] = {}
+		data['steps'] = []
 		
-		data['meta'][section_title] = {line.split('\t')[0]:line.split('\t')[1] for line in section.split('\n')}
-	
-	# obtain the different heat ramp numerical info
-	start_indices += [len(raw)] # add len of file so that slicing has a concrete end point.
-	for i in range(len(section_titles)):
-		if section_titles[i].strip().lower() == 'step':
-			step_data = {}
-			
-			sec_start = end_indices[i]
-			sec_end = start_indices[i+1]
-			section = raw[sec_start:sec_end-1]
-			lines = section.split('\n')
-			
-			# probs not very reliable for different kinds of out files.
-			step_data['program'] = lines[0]
-			step_data['variables'] = lines[1].split('\t')
-			step_data['units'] = lines[2].split('\t')
-
-			# get the numerical data. might have to do regex search in later release. 
-			step_data['num'] = [[float(num) for num in line.replace(',','.').split('\t') if num != ''] for line in lines[3:] if line != '']
-			
-			data['steps'].append(step_data)
+		for (sec_start,sec_end,section_title),(next_start,_,_) in pairwise(sections):
+
+			# obtain the different heat ramp numerical info
+			if section_title.strip().lower() == 'step':
+				step_data = {}
+				
+				section = read_section(raw,sec_end,next_start)[:-1]
+				lines = section.split('\n',3) # header lines + the numerical block as one string
+				
+				# probs not very reliable for different kinds of out files.
+				step_data['program'] = lines[0]
+				step_data['variables'] = lines[1].split('\t')
+				step_data['units'] = lines[2].split('\t')
+
+				# get the numerical data. incomplete rows (empty or missing cells) are dropped before parsing.
+				row_rex = r'(?m)^[^\t\n]+(?:\t[^\t\n]+){%d}$'%(len(step_data['variables'])-1) # a non-empty cell for every variable
+				block = '\n'.join(re.findall(row_rex,lines[3])).replace(',','.')
+				step_data['num'] = np.loadtxt(io.StringIO(block),delimiter='\t',ndmin=2)
+				
+				data['steps'].append(step_data)
+
+			# obtain the different meta data sections as dict.
+			else:
+				section = read_section(raw,sec_end,next_start)
+				data['meta'][section_title] = dict(line.partition('\t')[::2] for line in section.split('\n') if '\t' in line)
 
 	return data
 	
@@ -138,19 +139,102 @@ def json_writer(data:dict,path:str,indent=4):
 	'''Write the data (dict) to a json file. Location is specified by path (str).'''
 
 	with open(path,'w',encoding='utf8') as outf:
-		json.dump(data,outf,indent=indent,ensure_ascii=False)
+		json.dump(data,outf,indent=indent,ensure_ascii=False,default=lambda obj: obj.tolist()) # numerical data is stored as ndarray
+
+
+
+
+def get_cached_data(path:str):
+
+	'''Same as get_data, but stores the parsed data in a .npz file next to the input file and reads it from there
+	on the next run. The cache is keyed by path, modification time and size of the input file, stale caches of the
+	same input file are removed.'''
+
+	stat = os.stat(path)
+	key = hashlib.blake2b(f'{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()[:16]
+	stem = os.path.splitext(path)[0]
+	cache_path = stem + f'.{key}.npz'
+
+	if os.path.isfile(cache_path):
+		try:
+			with np.load(cache_path) as cache:
+				data = {'meta':json.loads(str(cache['meta'])),'steps':[]}
+				for i in range(int(cache['num_steps'])):
+					data['steps'].append({'program':str(cache[f'program_{i}']),
+						'variables':cache[f'variables_{i}'].tolist(),
+						'units':cache[f'units_{i}'].tolist(),
+						'num':cache[f'arr_{i}']})
+			return data
+		except (OSError,EOFError,ValueError,KeyError,zipfile.BadZipFile): # damaged cache, parse again and overwrite it
+			pass
+
+	data = get_data(path)
+
+	arrays = {'meta':json.dumps(data['meta'],ensure_ascii=False),'num_steps':len(data['steps'])}
+	for i,step in enumerate(data['steps']):
+		arrays[f'program_{i}'] = step['program']
+		arrays[f'variables_{i}'] = step['variables']
+		arrays[f'units_{i}'] = step['units']
+		arrays[f'arr_{i}'] = step['num']
+
+	tmp_path = cache_path + '.tmp'
+	try:
+		with open(tmp_path,'wb') as outf:
+			np.savez(outf,**arrays)
+		os.replace(tmp_path,cache_path) # only complete caches end up under the cache name
+
+		for old_cache in glob(glob_escape(stem) + '.*.npz'):
+			if old_cache != cache_path and _CACHE_KEY_RE.fullmatch(old_cache[len(stem):]): os.remove(old_cache) # not the caches of e.g. stem.1.txt
+	except OSError: # e.g. read only directory, just parse again next time
+		if os.path.exists(tmp_path): os.remove(tmp_path)
+
+	return data
+
 
 
 
+def get_key_index(alias:str,var_index:dict):
 
-def get_key_index(alias:str,steps:list):
+	'''Finds the index of a certian variable (like Temperature) based on an alias. var_index maps the normalised
+	variable names of a step to their column index (see plot_SDT).'''
 
-	'''Finds the index of a certian variable (like Temperature) based on an alias from the data['measurements'] section
-	of the data input.'''
+	alias = alias.strip().lower()
+	return next((i for name,i in var_index.items() if alias in name),None)
 
-	for i in range(len(steps)):
-		if alias.strip().lower() in steps[i].strip().lower():
-			return i 
+
+
+
+def downsample_lttb(x:np.ndarray,y:np.ndarray,n_out=2000):
+
+	'''Downsamples a trace to n_out points with the largest triangle three buckets algorithm. The first and last
+	point are kept; of every bucket in between the point spanning the largest triangle with the means of the previous
+	and the next bucket is kept, which preserves peaks. Using the previous bucket's mean instead of its kept point
+	makes the buckets independent, so all of them are evaluated at once. Returns the downsampled x and y arrays.'''
+
+	n = len(x)
+	if n <= n_out or n_out < 3:
+		return x,y
+
+	edges = np.linspace(1,n-1,n_out-1).astype(int) # n_out-2 buckets between the first and the last point
+	counts = np.diff(edges)
+	x_in, y_in = x[1:-1], y[1:-1]
+	x_mean = np.add.reduceat(x_in,edges[:-1]-1)/counts
+	y_mean = np.add.reduceat(y_in,edges[:-1]-1)/counts
+
+	# the triangle corners outside of each bucket, repeated for every point of the bucket
+	x_prev, y_prev = np.repeat(np.r_[x[0],x_mean[:-1]],counts), np.repeat(np.r_[y[0],y_mean[:-1]],counts)
+	x_next, y_next = np.repeat(np.r_[x_mean[1:],x[-1]],counts), np.repeat(np.r_[y_mean[1:],y[-1]],counts)
+
+	area = np.abs((x_prev-x_next)*(y_in-y_prev) - (x_prev-x_in)*(y_next-y_prev))
+
+	# first point with the largest area in every bucket
+	bucket = np.repeat(np.arange(len(counts)),counts)
+	largest = np.flatnonzero(area == np.repeat(np.maximum.reduceat(area,edges[:-1]-1),counts))
+	largest = largest[np.r_[True,bucket[largest][1:] != bucket[largest][:-1]]]
+
+	keep = np.r_[0,largest+1,n-1]
+
+	return x[keep],y[keep]
 
 
 
@@ -166,37 +250,66 @@ def plot_SDT(data:dict,outfile:str):
 		ind = label_index_dict[label]	
 		ax.lines[ind].set_visible(not ax.lines[ind].get_visible())
 		
-		fig.canvas.draw()
+		if blit:
+			fig.canvas.restore_region(blit_cache['background'])
+			draw_animated()
+			fig.canvas.blit(ax.bbox)
+		else:
+			fig.canvas.draw()
+
+
+	def draw_animated():
+
+		'''Draws the visible lines and the legend on top of the cached axes background.'''
+
+		for line in ax.lines:
+			if line.get_visible():
+				ax.draw_artist(line)
+		ax.draw_artist(ax.get_legend())
+
+
+	def on_draw(event):
+
+		'''Callback function for full redraws (first show, resize). Caches the axes background without the lines.
+		Draws made by savefig are skipped, they may use another canvas or dpi and already include the lines.'''
+
+		if event.canvas is not canvas or canvas.is_saving():
+			return
+
+		blit_cache['background'] = canvas.copy_from_bbox(ax.bbox)
+		draw_animated()
 
 
 	label_index_dict = {}
+	blit_cache = {}
 
 	fig = plt.figure(figsize=(10,3)) 
+	canvas = fig.canvas # the screen canvas, savefig temporarily swaps fig.canvas for other formats
+	blit = not args.silent and canvas.supports_blit # only redraw the lines when toggling them in the interactive window
 	gs = gridspec.GridSpec(1, 2, width_ratios=[2, 1])
 	ax = plt.subplot(gs[0])
 	rax = plt.subplot(gs[1]) 
 	gs.update(wspace=0.05)
 
 	for i in range(len(data['steps'])):
-		num_data = data['steps'][i]['num'] 
+		num_data = np.asarray(data['steps'][i]['num'],dtype=np.float64) # no copy if get_data already returned an ndarray
 		variables = data['steps'][i]['variables']
 		label = data['steps'][i]['program']
 
-		num_data = [tup for tup in num_data if len(tup) == len(variables)] # remove incomplete entries in num data
+		var_index = {var.strip().lower():ind for ind,var in enumerate(variables)} # normalise the names once per step
+		T_ind = get_key_index('temp',var_index)
+		HF_ind = get_key_index('heat',var_index)
 
-		t_ind = get_key_index('time',variables)
-		T_ind = get_key_index('temp',variables)
-		HF_ind = get_key_index('heat',variables)
+		T = num_data[:,T_ind]
+		HF = num_data[:,HF_ind]
 
-		t = np.array(num_data)[:,t_ind]
-		T = np.array(num_data)[:,T_ind]
-		HF = np.array(num_data)[:,HF_ind]
-
-		t_unit = variables[t_ind]
 		T_unit = variables[T_ind]
 		HF_unit = variables[HF_ind]
 		
-		ax.plot(T,HF,lw=0.7,label=label,alpha=0.5) # add color controls
+		if not args.silent:
+			T, HF = downsample_lttb(T,HF) # keep the interactive window responsive, saved figures use all points
+
+		ax.plot(T,HF,lw=0.7,label=label,alpha=0.5,animated=blit) # add color controls
 		label_index_dict[str(i+1)+'.'+label] = i
 
 
@@ -215,12 +328,13 @@ def plot_SDT(data:dict,outfile:str):
 	ax.xaxis.set_ticks_position('bottom')
 	ax.tick_params(axis='both',which='both',labelsize=10, direction='in')
 	
-	ax.legend(loc='best',fontsize=6)
+	ax.legend(loc='best',fontsize=6).set_animated(blit)
 
 	# here checkbox logic 
+	colors = [line.get_color() for line in ax.lines] # look up the line colors once for frame and check
 	label_props = {'fontsize':[8]*4}
-	frame_props = {'edgecolor': [ax.lines[i].get_color() for i in range(len(ax.lines))]}
-	check_props = {'sizes':[200]*4,'color':[ax.lines[i].get_color() for i in range(len(ax.lines))]}
+	frame_props = {'edgecolor':colors}
+	check_props = {'sizes':[200]*4,'color':colors}
 	
 	checkbox = CheckButtons(rax, label_index_dict.keys(),
 		actives=[True]*len(ax.lines),
@@ -230,13 +344,15 @@ def plot_SDT(data:dict,outfile:str):
 
 	rax.axis('off')
 	checkbox.on_clicked(toggle_visibility)
+	if blit:
+		fig.canvas.mpl_connect('draw_event',on_draw)
 
 	if not args.silent:
 		plt.show()
 	else:
 		# checkbox.remove() 
 		# plt.autoscale()
-		plt.savefig(outfile,dpi=500, bbox_inches='tight', transparent=False)
+		plt.savefig(outfile,dpi=args.dpi, bbox_inches='tight', transparent=False)
 	
 
 
@@ -245,5 +361,5 @@ infile = args.input_file
 if os.path.isdir(infile):
 	infile = get_default_input()
 
-data = get_data(infile)
+data = get_data(infile) if args.no_cache else get_cached_data(infile)
 plot_SDT(data,args.output_file)
\ No newline at end of file